@@ -4,10 +4,17 @@ Receives sensor data via BLE and stores in database
 """
 
 import asyncio
+import os
 import struct
 import sqlite3
+import sys
+import time
+from collections import deque
 from datetime import datetime
 from bleak import BleakScanner
+from bleak.args.bluez import OrPattern
+from bleak.assigned_numbers import AdvertisementDataType
+from bleak.exc import BleakDBusError, BleakError
 import logging
 
 # Configure logging
@@ -17,114 +24,291 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Module log level from LOG_LEVEL (e.g. DEBUG or WARNING)
+_log_level = os.environ.get('LOG_LEVEL', 'INFO').upper()
+if not isinstance(logging.getLevelName(_log_level), int):
+    logger.warning("Unknown LOG_LEVEL %r, using INFO", _log_level)
+    _log_level = 'INFO'
+logger.setLevel(_log_level)
+
 # Database configuration
 DB_PATH = "sensor_data.db"
 
 # RSSI threshold (signal strength)
 RSSI_THRESHOLD = -85  # Ignore weak signals
 
+# Scanner restart backoff after errors
+SCAN_RETRY_DELAY = 5         # Initial delay in seconds
+SCAN_RETRY_MAX_DELAY = 300   # Upper bound in seconds
+
+# Restart the scanner when no advert arrives for three sensor sleep intervals
+SCAN_IDLE_TIMEOUT = 3 * 900  # Seconds
+
+# Batch write settings
+FLUSH_INTERVAL = 2.0     # Seconds between batch writes
+FLUSH_BATCH_SIZE = 64    # Flush early once this many readings are pending
+FLUSH_RETRY_MAX_DELAY = 60   # Upper bound in seconds between failed flush retries
+MAX_PENDING = 10000      # Readings buffered while the database is unavailable
+
+# Retention settings
+RETENTION_DAYS = 30      # Readings older than this are purged
+PURGE_INTERVAL = 3600    # Seconds between purges
+
+# Only variable bins carry sensors
+BIN_ID_PREFIX = b'VAR_'
+
+# Advertisement layout: [BIN_ID(6), FILL(1), VOLTAGE(2), TIMESTAMP(4)]
+_ADV_STRUCT = struct.Struct('<6sBHI')
+
+# Schema version stored in PRAGMA user_version
+# 0: original layout (DATETIME text timestamps, UNIQUE(bin_id, sensor_timestamp))
+# 1: unix-second INTEGER timestamps, no UNIQUE constraint
+SCHEMA_VERSION = 1
+
+_CREATE_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS sensor_data (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        bin_id TEXT NOT NULL,
+        fill_level INTEGER NOT NULL,
+        battery_voltage REAL NOT NULL,
+        rssi INTEGER,
+        timestamp INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+        sensor_timestamp INTEGER
+    )
+'''
+
+# Shared INSERT text so sqlite3 reuses one prepared statement per flush
+_INSERT_SQL = (
+    "INSERT INTO sensor_data "
+    "(bin_id, fill_level, battery_voltage, rssi, sensor_timestamp) "
+    "VALUES (?, ?, ?, ?, ?)"
+)
+
 
 class BinDataGateway:
     """Gateway for receiving and processing bin sensor data"""
     
     def __init__(self, db_path=DB_PATH):
         self.db_path = db_path
+        self._write_conn = None
+        self._read_conn = None
+        self._pending = deque(maxlen=MAX_PENDING)  # Oldest readings drop first
+        self._flush_event = asyncio.Event()
+        self._flush_failed = False  # Retries wait for the flush timer
+        self._last_advert = 0.0  # Monotonic time of the last received advert
+        self._last_ts = {}  # bin_id -> last stored sensor_timestamp
         self.setup_database()
     
+    @staticmethod
+    def _apply_pragmas(conn):
+        """Tune connection for WAL journaling and fewer fsyncs"""
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA busy_timeout=5000')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute('PRAGMA cache_size=-20000')
+    
     def setup_database(self):
         """Initialize SQLite database"""
-        conn = sqlite3.connect(self.db_path)
+        conn = sqlite3.connect(
+            self.db_path, isolation_level=None, check_same_thread=False
+        )
+        self._apply_pragmas(conn)
+        self._write_conn = conn
         cursor = conn.cursor()
         
+        self._migrate_schema(conn)
+        
         # Create sensor_data table
+        cursor.execute(_CREATE_TABLE_SQL)
+        cursor.execute(f'PRAGMA user_version={SCHEMA_VERSION}')
+        
+        # Covering index so per-bin history queries never touch the table
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS sensor_data (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                bin_id TEXT NOT NULL,
-                fill_level INTEGER NOT NULL,
-                battery_voltage REAL NOT NULL,
-                rssi INTEGER,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                sensor_timestamp INTEGER,
-                UNIQUE(bin_id, sensor_timestamp)
-            )
+            CREATE INDEX IF NOT EXISTS idx_bin_cover 
+            ON sensor_data(bin_id, timestamp DESC, fill_level, battery_voltage, rssi)
         ''')
         
-        # Create index for faster queries
+        # Seed duplicate detection from the latest stored reading per bin
         cursor.execute('''
-            CREATE INDEX IF NOT EXISTS idx_bin_timestamp 
-            ON sensor_data(bin_id, timestamp DESC)
+            SELECT bin_id, sensor_timestamp
+            FROM sensor_data
+            WHERE id IN (
+                SELECT MAX(id)
+                FROM sensor_data
+                GROUP BY bin_id
+            )
         ''')
+        self._last_ts = dict(cursor.fetchall())
         
-        conn.commit()
-        conn.close()
         logger.info("Database initialized")
     
+    @staticmethod
+    def _migrate_schema(conn):
+        """Rebuild a sensor_data table created by an older schema version"""
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            return
+        
+        exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sensor_data'"
+        ).fetchone()
+        if not exists:
+            return
+        
+        logger.info("Migrating sensor_data from schema version %d", version)
+        
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('ALTER TABLE sensor_data RENAME TO sensor_data_old')
+            conn.execute(_CREATE_TABLE_SQL)
+            # Old rows hold DATETIME text; convert it to unix seconds
+            conn.execute('''
+                INSERT INTO sensor_data
+                (id, bin_id, fill_level, battery_voltage, rssi, timestamp, sensor_timestamp)
+                SELECT id, bin_id, fill_level, battery_voltage, rssi,
+                       CASE WHEN typeof(timestamp) = 'integer' THEN timestamp
+                            ELSE CAST(strftime('%s', timestamp) AS INTEGER) END,
+                       sensor_timestamp
+                FROM sensor_data_old
+            ''')
+            conn.execute('DROP TABLE sensor_data_old')
+            conn.execute(f'PRAGMA user_version={SCHEMA_VERSION}')
+            conn.execute('COMMIT')
+        except Exception:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+    
+    def _get_read_conn(self):
+        """Lazily open the reader connection"""
+        if self._read_conn is None:
+            self._read_conn = sqlite3.connect(
+                self.db_path, check_same_thread=False
+            )
+            self._apply_pragmas(self._read_conn)
+        return self._read_conn
+    
+    def close(self):
+        """Flush pending readings and close database connections"""
+        if self._write_conn is not None:
+            self.flush_pending()
+        for conn in (self._write_conn, self._read_conn):
+            if conn is not None:
+                conn.close()
+        self._write_conn = None
+        self._read_conn = None
+        logger.info("Database connections closed")
+    
     def parse_manufacturer_data(self, manufacturer_data):
         """
         Parse manufacturer data from BLE advertisement
         Format: [BIN_ID(6), FILL(1), VOLTAGE(2), TIMESTAMP(4)]
+        Caller must ensure the payload is at least _ADV_STRUCT.size bytes
         """
-        try:
-            if len(manufacturer_data) < 13:
-                return None
-            
-            # Extract bin ID (6 bytes)
-            bin_id = manufacturer_data[0:6].decode('utf-8', errors='ignore').strip()
-            
-            # Extract fill level (1 byte)
-            fill_level = manufacturer_data[6]
-            
-            # Extract voltage (2 bytes, little-endian)
-            voltage_mv = struct.unpack('<H', manufacturer_data[7:9])[0]
-            voltage = voltage_mv / 1000.0
-            
-            # Extract sensor timestamp (4 bytes, little-endian)
-            sensor_timestamp = struct.unpack('<I', manufacturer_data[9:13])[0]
-            
-            return {
-                'bin_id': bin_id,
-                'fill_level': fill_level,
-                'battery_voltage': voltage,
-                'sensor_timestamp': sensor_timestamp
-            }
-        except Exception as e:
-            logger.error(f"Error parsing manufacturer data: {e}")
-            return None
+        bin_id_b, fill_level, voltage_mv, sensor_timestamp = \
+            _ADV_STRUCT.unpack_from(manufacturer_data, 0)
+        bin_id = bin_id_b.decode('ascii', 'ignore').rstrip('\x00 ')
+        voltage = voltage_mv / 1000.0
+        
+        return {
+            'bin_id': bin_id,
+            'fill_level': fill_level,
+            'battery_voltage': voltage,
+            'sensor_timestamp': sensor_timestamp
+        }
     
     def store_sensor_data(self, data, rssi):
-        """Store sensor data in database"""
+        """Queue sensor data for the next batch write"""
+        self._pending.append((
+            data['bin_id'],
+            data['fill_level'],
+            data['battery_voltage'],
+            rssi,
+            data['sensor_timestamp']
+        ))
+        
+        logger.debug(
+            "Queued: %s - Fill: %d%% - Battery: %.2fV - RSSI: %ddBm",
+            data['bin_id'], data['fill_level'], data['battery_voltage'], rssi
+        )
+        
+        if len(self._pending) >= FLUSH_BATCH_SIZE and not self._flush_failed:
+            self._flush_event.set()
+    
+    def flush_pending(self):
+        """
+        Write all queued readings in a single transaction
+        Runs on the event loop thread without awaiting, so detection
+        callbacks cannot interleave with the queue swap and no lock is needed
+        Returns: False if the write failed and the readings were requeued
+        """
+        if not self._pending:
+            return True
+        
+        pending = self._pending
+        self._pending = deque(maxlen=MAX_PENDING)
+        conn = self._write_conn
+        
+        # Sensors repeat each reading for the whole advertising window;
+        # keep only rows whose sensor_timestamp changed for that bin
+        last_ts = self._last_ts
+        batch_ts = {}
+        rows = []
+        for row in pending:
+            bin_id, sensor_timestamp = row[0], row[4]
+            if batch_ts.get(bin_id, last_ts.get(bin_id)) == sensor_timestamp:
+                continue
+            batch_ts[bin_id] = sensor_timestamp
+            rows.append(row)
+        
+        if not rows:
+            return True
+        
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                INSERT OR IGNORE INTO sensor_data 
-                (bin_id, fill_level, battery_voltage, rssi, sensor_timestamp)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (
-                data['bin_id'],
-                data['fill_level'],
-                data['battery_voltage'],
-                rssi,
-                data['sensor_timestamp']
-            ))
-            
-            if cursor.rowcount > 0:
-                logger.info(
-                    f"Stored: {data['bin_id']} - "
-                    f"Fill: {data['fill_level']}% - "
-                    f"Battery: {data['battery_voltage']:.2f}V - "
-                    f"RSSI: {rssi}dBm"
-                )
-            
-            conn.commit()
-            conn.close()
+            conn.execute('BEGIN IMMEDIATE')
+            conn.executemany(_INSERT_SQL, rows)
+            conn.execute('COMMIT')
         except Exception as e:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
             logger.error(f"Error storing data: {e}")
+            
+            # Keep the rows for the next flush, dropping the oldest on overflow
+            dropped = max(0, len(rows) + len(self._pending) - MAX_PENDING)
+            rows.extend(self._pending)
+            self._pending = deque(rows, maxlen=MAX_PENDING)
+            if dropped:
+                logger.warning("Pending queue full; dropped %d oldest readings", dropped)
+            self._flush_failed = True
+            return False
+        
+        last_ts.update(batch_ts)
+        self._flush_failed = False
+        logger.info("Flushed %d readings", len(rows))
+        return True
+    
+    async def flush_loop(self):
+        """Periodically flush queued readings to the database"""
+        delay = FLUSH_INTERVAL
+        
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_event.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_event.clear()
+            
+            # Back off while the database keeps failing
+            if self.flush_pending():
+                delay = FLUSH_INTERVAL
+            else:
+                delay = min(delay * 2, FLUSH_RETRY_MAX_DELAY)
     
     def detection_callback(self, device, advertisement_data):
         """Callback for BLE device detection"""
+        self._last_advert = time.monotonic()
+        
         try:
             # Check RSSI threshold
             rssi = advertisement_data.rssi
@@ -137,72 +321,152 @@ class BinDataGateway:
             
             # Get manufacturer data (typically key is company ID)
             for company_id, data in advertisement_data.manufacturer_data.items():
-                parsed_data = self.parse_manufacturer_data(data)
+                # Reject foreign devices before decoding
+                if len(data) < _ADV_STRUCT.size or not data.startswith(BIN_ID_PREFIX):
+                    continue
                 
-                if parsed_data:
-                    # Check for valid bin ID prefix
-                    if parsed_data['bin_id'].startswith('VAR_'):
-                        self.store_sensor_data(parsed_data, rssi)
+                parsed_data = self.parse_manufacturer_data(data)
+                self.store_sensor_data(parsed_data, rssi)
         
         except Exception as e:
             logger.error(f"Error in detection callback: {e}")
     
+    def purge_old_readings(self):
+        """Delete readings older than the retention window"""
+        cutoff = int(time.time()) - RETENTION_DAYS * 86400
+        
+        try:
+            cursor = self._write_conn.execute(
+                'DELETE FROM sensor_data WHERE timestamp < ?', (cutoff,)
+            )
+            logger.info("Purged %d old readings", cursor.rowcount)
+        except Exception as e:
+            logger.error(f"Error purging data: {e}")
+    
+    async def purge_loop(self):
+        """Periodically purge readings past retention"""
+        while True:
+            self.purge_old_readings()
+            await asyncio.sleep(PURGE_INTERVAL)
+    
+    def create_scanner(self, passive=False):
+        """
+        Create the BLE scanner
+        Passive mode (BlueZ only) lets the kernel drop adverts whose
+        manufacturer payload does not start with the bin ID prefix
+        """
+        if passive:
+            return BleakScanner(
+                detection_callback=self.detection_callback,
+                scanning_mode='passive',
+                bluez={
+                    'or_patterns': [
+                        # AD data for this type is the 2-byte company ID
+                        # followed by the payload Bleak reports
+                        OrPattern(
+                            2,
+                            AdvertisementDataType.MANUFACTURER_SPECIFIC_DATA,
+                            BIN_ID_PREFIX
+                        )
+                    ]
+                }
+            )
+        
+        return BleakScanner(detection_callback=self.detection_callback)
+    
+    @staticmethod
+    def _passive_unsupported(error):
+        """Whether a scanner start error means BlueZ lacks advertisement monitors"""
+        if isinstance(error, BleakDBusError):
+            return error.dbus_error == 'org.bluez.Error.NotSupported'
+        # Bleak's own message for a missing AdvertisementMonitorManager1
+        return isinstance(error, BleakError) and 'passive scanning' in str(error)
+    
     async def start_scanning(self):
         """Start continuous BLE scanning"""
         logger.info("Starting BLE scanning...")
         
-        scanner = BleakScanner(detection_callback=self.detection_callback)
+        passive = sys.platform.startswith('linux')
+        scanner = self.create_scanner(passive)
+        flush_task = asyncio.create_task(self.flush_loop())
+        purge_task = asyncio.create_task(self.purge_loop())
         
-        while True:
-            try:
-                await scanner.start()
-                await asyncio.sleep(60)  # Scan for 60 seconds
-                await scanner.stop()
-                
-                logger.info("Scan cycle completed. Restarting...")
-                await asyncio.sleep(1)
-                
-            except Exception as e:
-                logger.error(f"Scanning error: {e}")
-                await asyncio.sleep(5)
+        backoff = SCAN_RETRY_DELAY
+        
+        try:
+            while True:
+                try:
+                    try:
+                        await scanner.start()
+                    except Exception as e:
+                        if not passive or not self._passive_unsupported(e):
+                            raise
+                        logger.warning(
+                            "Passive scanning unavailable (%s); falling back to active scanning", e
+                        )
+                        passive = False
+                        scanner = self.create_scanner(passive)
+                        continue
+                    backoff = SCAN_RETRY_DELAY
+                    self._last_advert = time.monotonic()
+                    try:
+                        # Scan until cancelled or adverts stop arriving,
+                        # which means the adapter or BlueZ dropped
+                        while True:
+                            idle = time.monotonic() - self._last_advert
+                            if idle >= SCAN_IDLE_TIMEOUT:
+                                logger.warning(
+                                    "No advertisements for %ds; restarting scanner", SCAN_IDLE_TIMEOUT
+                                )
+                                break
+                            await asyncio.sleep(SCAN_IDLE_TIMEOUT - idle)
+                    finally:
+                        await scanner.stop()
+                    
+                except Exception as e:
+                    logger.error(f"Scanning error: {e}")
+                    logger.info("Restarting scanner in %.0fs", backoff)
+                    await asyncio.sleep(backoff)
+                    backoff = min(backoff * 2, SCAN_RETRY_MAX_DELAY)
+        finally:
+            flush_task.cancel()
+            purge_task.cancel()
+            self.flush_pending()
     
     def get_latest_readings(self):
         """Get latest reading for each bin"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        cursor = self._get_read_conn().cursor()
         
         cursor.execute('''
             SELECT bin_id, fill_level, battery_voltage, 
                    timestamp, rssi
-            FROM sensor_data s1
-            WHERE timestamp = (
-                SELECT MAX(timestamp) 
-                FROM sensor_data s2 
-                WHERE s2.bin_id = s1.bin_id
+            FROM sensor_data
+            WHERE id IN (
+                SELECT MAX(id)
+                FROM sensor_data
+                GROUP BY bin_id
             )
             ORDER BY bin_id
         ''')
         
         results = cursor.fetchall()
-        conn.close()
         
         return results
     
     def get_bin_history(self, bin_id, hours=24):
         """Get historical data for a specific bin"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        cursor = self._get_read_conn().cursor()
+        cutoff = int(time.time()) - hours * 3600
         
         cursor.execute('''
             SELECT fill_level, battery_voltage, timestamp, rssi
             FROM sensor_data
             WHERE bin_id = ?
-            AND timestamp >= datetime('now', '-' || ? || ' hours')
+            AND timestamp >= ?
             ORDER BY timestamp DESC
-        ''', (bin_id, hours))
+        ''', (bin_id, cutoff))
         
         results = cursor.fetchall()
-        conn.close()
         
         return results
 
@@ -218,6 +482,8 @@ def main():
         logger.info("Gateway stopped by user")
     except Exception as e:
         logger.error(f"Gateway error: {e}")
+    finally:
+        gateway.close()
 
 
 if __name__ == "__main__":
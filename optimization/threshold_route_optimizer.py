@@ -6,15 +6,30 @@ Applies fill-level threshold and generates optimized collection routes
 
 import sqlite3
 import math
+import numpy as np
 from datetime import datetime
 from typing import List, Dict, Tuple
 import json
 
+try:
+    import numba
+except ImportError:  # Fall back to the NumPy nearest neighbor search
+    numba = None
+
+try:
+    import orjson
+except ImportError:  # Fall back to the standard library serializer
+    orjson = None
+
 # Configuration
 DB_PATH = "sensor_data.db"
 FILL_THRESHOLD = 75  # Percentage threshold for collection
 BATTERY_WARNING_THRESHOLD = 20  # Battery warning level (%)
 
+# Loading the compiled Numba kernel costs ~0.14 s per process, which only
+# beats the NumPy search on routes with thousands of stops
+NN_JIT_MIN_STOPS = 10000
+
 # Always-full bins (high-priority locations)
 ALWAYS_FULL_BINS = [
     {"id": "STATIC_001", "name": "Dorm A Entrance", "lat": 40.7580, "lon": 29.9220},
@@ -39,49 +54,74 @@ VARIABLE_BINS = [
 ENTRY_POINT = {"id": "START", "name": "Campus Gate", "lat": 40.7570, "lon": 29.9210}
 
 
+def _nn_route(dist: np.ndarray) -> np.ndarray:
+    """
+    Nearest neighbor visit order over a distance matrix, starting at index 0
+    Plain loops for Numba to compile; see _nn_route_jit
+    Returns: indices 1..n-1 in visiting order
+    """
+    n = dist.shape[0]
+    visited = np.zeros(n, dtype=np.bool_)
+    visited[0] = True
+    order = np.empty(n - 1, dtype=np.int64)
+    current = 0
+    
+    for k in range(n - 1):
+        # Finite sentinel: fastmath assumes no infinities
+        min_d = 1e300
+        min_j = -1
+        for j in range(1, n):
+            if not visited[j] and dist[current, j] < min_d:
+                min_d = dist[current, j]
+                min_j = j
+        
+        visited[min_j] = True
+        order[k] = min_j
+        current = min_j
+    
+    return order
+
+
+# Compiled lazily on first use, so short routes never pay for it
+_nn_route_jit = numba.njit(cache=True, fastmath=True)(_nn_route) if numba else None
+
+
 class ThresholdProcessor:
     """Processes sensor data and applies threshold logic"""
     
     def __init__(self, db_path=DB_PATH):
         self.db_path = db_path
     
-    def get_latest_sensor_data(self) -> Dict[str, Dict]:
+    def get_latest_sensor_data(self) -> Dict[str, Tuple[int, float, int]]:
         """Retrieve latest sensor reading for each bin"""
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
         
         cursor.execute('''
             SELECT bin_id, fill_level, battery_voltage, timestamp
-            FROM sensor_data s1
-            WHERE timestamp = (
-                SELECT MAX(timestamp) 
-                FROM sensor_data s2 
-                WHERE s2.bin_id = s1.bin_id
+            FROM sensor_data
+            WHERE id IN (
+                SELECT MAX(id)
+                FROM sensor_data
+                GROUP BY bin_id
             )
         ''')
         
-        results = cursor.fetchall()
+        # bin_id -> (fill_level, battery_voltage, unix timestamp)
+        sensor_data = {r[0]: (r[1], r[2], r[3]) for r in cursor.fetchall()}
         conn.close()
         
-        sensor_data = {}
-        for row in results:
-            bin_id, fill_level, battery_voltage, timestamp = row
-            sensor_data[bin_id] = {
-                'fill_level': fill_level,
-                'battery_voltage': battery_voltage,
-                'timestamp': timestamp
-            }
-        
         return sensor_data
     
-    def apply_threshold(self, threshold=FILL_THRESHOLD) -> Tuple[List[Dict], List[str]]:
+    def apply_threshold(self, threshold=FILL_THRESHOLD) -> Tuple[List[Dict], List[str], int]:
         """
         Apply fill-level threshold to determine which bins to collect
-        Returns: (bins_to_collect, low_battery_warnings)
+        Returns: (bins_to_collect, low_battery_warnings, dynamic_count)
         """
         sensor_data = self.get_latest_sensor_data()
         bins_to_collect = []
         low_battery_bins = []
+        dynamic_count = 0
         
         # Add all always-full bins
         for bin_info in ALWAYS_FULL_BINS:
@@ -94,50 +134,56 @@ class ThresholdProcessor:
                 'type': 'static'
             })
         
+        # Bind hot-loop lookups to locals
+        sd_get = sensor_data.get
+        batt_thresh = BATTERY_WARNING_THRESHOLD
+        thresh = threshold
+        append_bin = bins_to_collect.append
+        
         # Process variable bins
         for bin_info in VARIABLE_BINS:
-            bin_id = bin_info['id']
+            bin_id, name, lat, lon = bin_info['id'], bin_info['name'], bin_info['lat'], bin_info['lon']
             
-            if bin_id in sensor_data:
-                data = sensor_data[bin_id]
-                fill_level = data['fill_level']
-                battery_voltage = data['battery_voltage']
+            data = sd_get(bin_id)
+            if data is not None:
+                fill_level, battery_voltage, _ = data
                 
                 # Check battery level (assuming 3.0V = 0%, 4.2V = 100%)
                 battery_percent = ((battery_voltage - 3.0) / 1.2) * 100
-                if battery_percent < BATTERY_WARNING_THRESHOLD:
+                if battery_percent < batt_thresh:
                     low_battery_bins.append(bin_id)
                 
                 # Apply threshold
-                if fill_level >= threshold:
-                    bins_to_collect.append({
+                if fill_level >= thresh:
+                    dynamic_count += 1
+                    append_bin({
                         'id': bin_id,
-                        'name': bin_info['name'],
-                        'lat': bin_info['lat'],
-                        'lon': bin_info['lon'],
+                        'name': name,
+                        'lat': lat,
+                        'lon': lon,
                         'fill_level': fill_level,
                         'type': 'dynamic',
                         'battery_voltage': battery_voltage
                     })
-                    print(f"✓ {bin_id} included: {fill_level}% (≥ {threshold}%)")
+                    print(f"✓ {bin_id} included: {fill_level}% (≥ {thresh}%)")
                 else:
-                    print(f"✗ {bin_id} skipped: {fill_level}% (< {threshold}%)")
+                    print(f"✗ {bin_id} skipped: {fill_level}% (< {thresh}%)")
             else:
                 print(f"⚠ {bin_id}: No sensor data available (sensor fault?)")
         
-        return bins_to_collect, low_battery_bins
+        return bins_to_collect, low_battery_bins, dynamic_count
     
     def generate_report(self, threshold=FILL_THRESHOLD):
         """Generate threshold processing report"""
-        bins_to_collect, low_battery = self.apply_threshold(threshold)
+        bins_to_collect, low_battery, dynamic_count = self.apply_threshold(threshold)
         
         report = {
             'timestamp': datetime.now().isoformat(),
             'threshold_used': threshold,
             'total_bins': len(ALWAYS_FULL_BINS) + len(VARIABLE_BINS),
             'static_bins_included': len(ALWAYS_FULL_BINS),
-            'dynamic_bins_included': len([b for b in bins_to_collect if b['type'] == 'dynamic']),
-            'dynamic_bins_skipped': len(VARIABLE_BINS) - len([b for b in bins_to_collect if b['type'] == 'dynamic']),
+            'dynamic_bins_included': dynamic_count,
+            'dynamic_bins_skipped': len(VARIABLE_BINS) - dynamic_count,
             'bins_to_collect': bins_to_collect,
             'warnings': {
                 'low_battery': low_battery
@@ -148,55 +194,102 @@ class ThresholdProcessor:
 
 
 class RouteOptimizer:
-    """Optimizes collection route using nearest neighbor algorithm"""
+    """Optimizes collection route using nearest neighbor algorithm with 2-opt refinement"""
+    
+    # Equirectangular projection around the campus latitude; over the few
+    # hundred meters between bins it matches haversine on the same 6371 km
+    # sphere to well under 0.01%
+    _COSLAT0 = math.cos(math.radians(40.758))
+    _M_PER_DEG = 6371 * math.pi / 180 * 1000
     
     @staticmethod
-    def calculate_distance(point1: Dict, point2: Dict) -> float:
-        """Calculate haversine distance between two GPS coordinates (in km)"""
-        lat1, lon1 = math.radians(point1['lat']), math.radians(point1['lon'])
-        lat2, lon2 = math.radians(point2['lat']), math.radians(point2['lon'])
-        
-        dlat = lat2 - lat1
-        dlon = lon2 - lon1
+    def distance_matrix(lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+        """Pairwise distances between GPS coordinates (in km)"""
+        lons = lons * RouteOptimizer._COSLAT0
         
-        a = math.sin(dlat/2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon/2)**2
-        c = 2 * math.asin(math.sqrt(a))
+        dy = lats[:, None] - lats[None, :]
+        dx = lons[:, None] - lons[None, :]
         
-        # Earth radius in kilometers
-        r = 6371
-        
-        return c * r
+        return RouteOptimizer._M_PER_DEG * np.sqrt(dx*dx + dy*dy) / 1000
     
     @staticmethod
     def nearest_neighbor_tsp(bins: List[Dict], start_point: Dict) -> Tuple[List[Dict], float]:
         """
-        Simple nearest neighbor algorithm for TSP
+        Simple nearest neighbor algorithm for TSP, refined with 2-opt
         Returns: (optimized_route, total_distance)
         """
-        unvisited = bins.copy()
-        route = [start_point]
-        current = start_point
-        total_distance = 0.0
+        # Index 0 is the start point, bins follow
+        points = [start_point] + bins
+        dist = RouteOptimizer.distance_matrix(
+            np.array([p['lat'] for p in points]),
+            np.array([p['lon'] for p in points])
+        )
         
-        while unvisited:
-            # Find nearest unvisited bin
-            nearest = min(unvisited, 
-                         key=lambda bin: RouteOptimizer.calculate_distance(current, bin))
-            
-            distance = RouteOptimizer.calculate_distance(current, nearest)
-            total_distance += distance
-            
-            route.append(nearest)
-            unvisited.remove(nearest)
-            current = nearest
+        if _nn_route_jit is not None and len(bins) >= NN_JIT_MIN_STOPS:
+            order = _nn_route_jit(dist).tolist()
+        else:
+            order = RouteOptimizer.nearest_neighbor_order(dist)
+        
+        legs = [0] + order + [0]
+        legs = RouteOptimizer.two_opt(legs, dist)
+        
+        # Leg distances along start -> bins -> start
+        total_distance = float(dist[legs[:-1], legs[1:]].sum())
         
-        # Return to start point
-        return_distance = RouteOptimizer.calculate_distance(current, start_point)
-        total_distance += return_distance
-        route.append(start_point)
+        route = [points[j] for j in legs]
         
         return route, total_distance
     
+    @staticmethod
+    def nearest_neighbor_order(dist: np.ndarray) -> List[int]:
+        """
+        Visit order of point indices starting from index 0
+        Returns: indices of points 1..n-1 in visiting order
+        """
+        n = len(dist)
+        visited = np.zeros(n, dtype=bool)
+        visited[0] = True
+        order = []
+        current = 0
+        
+        for _ in range(n - 1):
+            # Find nearest unvisited point
+            nearest = int(np.argmin(dist[current] + visited * 1e18))
+            visited[nearest] = True
+            order.append(nearest)
+            current = nearest
+        
+        return order
+    
+    @staticmethod
+    def two_opt(tour: List[int], dist: np.ndarray) -> List[int]:
+        """
+        Improve a closed tour of point indices by reversing segments
+        Each pass checks every segment end for a fixed start at once
+        Returns: improved tour with the same endpoints
+        """
+        r = np.array(tour)
+        n = len(r)
+        improved = True
+        
+        while improved:
+            improved = False
+            for i in range(1, n - 2):
+                a, b = r[i - 1], r[i]
+                js = np.arange(i + 1, n - 1)
+                c, d = r[js], r[js + 1]
+                
+                # Length change from replacing edges (a,b),(c,d) with (a,c),(b,d)
+                delta = dist[a, c] + dist[b, d] - dist[a, b] - dist[c, d]
+                k = int(np.argmin(delta))
+                
+                if delta[k] < -1e-12:
+                    j = js[k]
+                    r[i:j + 1] = r[i:j + 1][::-1].copy()
+                    improved = True
+        
+        return r.tolist()
+    
     @staticmethod
     def generate_route(bins_to_collect: List[Dict]) -> Dict:
         """Generate optimized route"""
@@ -275,8 +368,12 @@ def main():
         'optimized_route': route_info
     }
     
-    with open('route_output.json', 'w') as f:
-        json.dump(output, f, indent=2)
+    if orjson is not None:
+        with open('route_output.json', 'wb') as f:
+            f.write(orjson.dumps(output, option=orjson.OPT_INDENT_2))
+    else:
+        with open('route_output.json', 'w') as f:
+            json.dump(output, f, indent=2)
     
     print("\n" + "=" * 60)
     print("Route saved to: route_output.json")